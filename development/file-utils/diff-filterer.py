@@ -16,11 +16,11 @@
 #
 
 
-import datetime, filecmp, math, multiprocessing, os, shutil, subprocess, stat, sys, time
-from collections import OrderedDict
+import concurrent.futures, datetime, fcntl, hashlib, heapq, itertools, math, multiprocessing, os, shutil, subprocess, stat, sys, time
+from queue import Empty
 
 def usage():
-  print("""Usage: diff-filterer.py [--assume-no-side-effects] [--assume-input-states-are-correct] [--work-path <workpath>] [--num-jobs <count>] [--timeout <seconds>] [--debug] <passingPath> <failingPath> <shellCommand>
+  print("""Usage: diff-filterer.py [--assume-no-side-effects] [--assume-input-states-are-correct] [--work-path <workpath>] [--num-jobs <count>] [--split-running-jobs] [--timeout <seconds>] [--debug] <passingPath> <failingPath> <shellCommand>
 
 diff-filterer.py attempts to transform (a copy of) the contents of <passingPath> into the contents of <failingPath> subject to the constraint that when <shellCommand> is run in that directory, it returns 0
 
@@ -35,6 +35,9 @@ OPTIONS
   --num-jobs <count>
     The maximum number of concurrent executions of <shellCommand> to spawn at once
     Specify 'auto' to have diff-filterer.py dynamically adjust the number of jobs based on system load
+  --split-running-jobs
+    When a job slot is idle and nothing is waiting to be tested, split up the largest job that has run longer than the average test, and test its pieces too
+    This can help when a few tests take much longer than the others, but it usually runs more tests in total
   --timeout <seconds>
     Approximate maximum amount of time to run. If diff-filterer.py expects that running a test would exceed this timeout, then it will skip running the test, terminate early, and report what it did find.
     diff-filterer.py doesn't terminate any child processes that have already started, so it is still possible that diff-filterer.py might exceed this timeout by the amount of time required to run one test.
@@ -45,16 +48,34 @@ OPTIONS
 
 debug = False
 
+# ioctl request that asks Linux to make a file share the data of another file (from linux/fs.h)
+FICLONE = 0x40049409
+
 # Miscellaneous file utilities
 class FileIo(object):
   def __init__(self):
-    return
+    # During a batch (see beginBatch), the set of directories that we know exist, so we don't have to check them again
+    self.knownDirs = None
+
+  # Starts a batch of changes during which nothing else is expected to modify the filesystem
+  # This allows us to remember which directories exist rather than checking again for each file
+  def beginBatch(self):
+    self.knownDirs = set()
+
+  def endBatch(self):
+    self.knownDirs = None
 
   def ensureDirExists(self, filePath):
-    if not os.path.isdir(filePath):
-      if os.path.isfile(filePath) or os.path.islink(filePath):
-        os.remove(filePath)
+    if self.knownDirs is not None and filePath in self.knownDirs:
+      return
+    try:
+      os.makedirs(filePath, exist_ok=True)
+    except FileExistsError:
+      # something other than a directory is in the way
+      os.remove(filePath)
       os.makedirs(filePath)
+    if self.knownDirs is not None:
+      self.knownDirs.add(filePath)
 
   def copyFile(self, fromPath, toPath):
     self.ensureDirExists(os.path.dirname(toPath))
@@ -63,12 +84,49 @@ class FileIo(object):
       linkText = os.readlink(fromPath)
       os.symlink(linkText, toPath)
     else:
+      self.copyRegularFile(fromPath, toPath)
+
+  # copies the content, permissions and modification time of <fromPath> to <toPath>
+  # Where possible, this has the kernel do the copy (which some filesystems can do without copying any data)
+  def copyRegularFile(self, fromPath, toPath):
+    fromFd = os.open(fromPath, os.O_RDONLY)
+    try:
+      fromStat = os.fstat(fromFd)
+      toFd = os.open(toPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      try:
+        copied = self.copyContentInKernel(fromFd, toFd, fromStat.st_size)
+        if copied:
+          os.fchmod(toFd, stat.S_IMODE(fromStat.st_mode))
+          os.utime(toFd, ns=(fromStat.st_atime_ns, fromStat.st_mtime_ns))
+      finally:
+        os.close(toFd)
+    finally:
+      os.close(fromFd)
+    if not copied:
       shutil.copy2(fromPath, toPath)
 
-  def hardLink(self, oldPath, newPath):
-    self.ensureDirExists(os.path.dirname(newPath))
-    self.removePath(newPath)
-    os.link(oldPath, newPath)
+  # tries to copy <size> bytes from <fromFd> into the empty file <toFd> without reading them into this process
+  # returns whether it succeeded
+  def copyContentInKernel(self, fromFd, toFd, size):
+    try:
+      # on filesystems that support reflinks (such as btrfs and xfs), this makes both files share the same data
+      fcntl.ioctl(toFd, FICLONE, fromFd)
+      return True
+    except OSError:
+      pass
+    if not hasattr(os, "copy_file_range"):
+      return False
+    try:
+      remaining = size
+      while remaining > 0:
+        numCopied = os.copy_file_range(fromFd, toFd, remaining)
+        if numCopied == 0:
+          break
+        remaining -= numCopied
+      return True
+    except OSError:
+      # copy_file_range isn't supported here (for example, by this kernel or filesystem)
+      return False
 
   def writeFile(self, path, text):
     f = open(path, "w+")
@@ -82,12 +140,34 @@ class FileIo(object):
   def removePath(self, filePath):
     if len(os.path.split(filePath)) < 2:
       raise Exception("Will not remove path at " + filePath + "; is too close to the root of the filesystem")
-    if os.path.islink(filePath):
+    # Most of the paths that we remove are files, so we try that first rather than checking the type of the path
+    try:
       os.remove(filePath)
-    elif os.path.isdir(filePath):
+    except (FileNotFoundError, NotADirectoryError):
+      return
+    except OSError:
+      # os.remove doesn't remove directories (and the error it gives for them depends on the platform)
+      if not stat.S_ISDIR(os.lstat(filePath).st_mode):
+        raise
       shutil.rmtree(filePath)
-    elif os.path.isfile(filePath):
-      os.remove(filePath)
+      if self.knownDirs is not None:
+        # we don't keep track of which known dirs were inside this one
+        self.knownDirs.clear()
+      return
+    if self.knownDirs is not None:
+      # for example, this could have been a symlink to a directory
+      self.knownDirs.discard(filePath)
+
+  # returns a hash of the content of the file at <filePath>
+  def hashFile(self, filePath):
+    with open(filePath, "rb") as f:
+      if hasattr(hashlib, "file_digest"):
+        # Python 3.11+ reads and hashes the file in C without making Python objects for each block
+        return hashlib.file_digest(f, "sha256").hexdigest()
+      hasher = hashlib.sha256()
+      for block in iter(lambda: f.read(1024 * 1024), b""):
+        hasher.update(block)
+      return hasher.hexdigest()
 
   def join(self, path1, path2):
     return os.path.normpath(os.path.join(path1, path2))
@@ -130,52 +210,25 @@ fileIo = FileIo()
 
 # Returns cpu usage
 class CpuStats(object):
+  def __init__(self):
+    # the most recent result of cpu_times_percent and when we computed it
+    self.lastSample = None
+    self.lastSampleTime = None
+    # how long to reuse a sample for
+    # Usage measured over shorter intervals than this is noisy, and measuring it requires reading from /proc
+    self.minSampleIntervalSeconds = 1
 
   def cpu_times_percent(self):
-    # We wait to attempt to import psutil in case we don't need it and it doesn't exist on this system
-    import psutil
-    return psutil.cpu_times_percent(interval=None)
+    now = time.monotonic()
+    if self.lastSample is None or now - self.lastSampleTime >= self.minSampleIntervalSeconds:
+      # We wait to attempt to import psutil in case we don't need it and it doesn't exist on this system
+      import psutil
+      self.lastSample = psutil.cpu_times_percent(interval=None)
+      self.lastSampleTime = now
+    return self.lastSample
 
 cpuStats = CpuStats()
 
-# Fast file copying
-class FileCopyCache(object):
-  def __init__(self):
-    self.modificationTimes = {}
-
-  # Puts a copy of <sourcePath> at <destPath>
-  # If we already have an unmodified copy, we just hardlink our existing unmodified copy
-  # If we don't have an unmodified copy, we first make a copy
-  def copyFile(self, sourcePath, destPath, cachePath):
-    if cachePath is None:
-      fileIo.copyFile(sourcePath, destPath)
-    else:
-      shareable = self.getShareableFile(sourcePath, cachePath)
-      fileIo.hardLink(shareable, destPath)
-
-  # gets a shareable copy of <sourcePath> in <cachePath> and returns its path
-  def getShareableFile(self, sourcePath, cachePath):
-    # note that absolute sourcePath is supported
-    path = os.path.abspath(cachePath + "/" + sourcePath)
-    if path in self.modificationTimes:
-      # we've already shared this file before; let's check whether it has been modified since then
-      if self.modificationTimes[path] == self.getModificationTime(path):
-        # this file hasn't been modified since we last shared it; we can just reuse it
-        return path
-    # we don't have an existing file that we can reuse, so we have to make one
-    fileIo.copyFile(sourcePath, path)
-    self.modificationTimes[path] = self.getModificationTime(path)
-    return path
-
-  # returns the time at which <path> was last modified
-  def getModificationTime(self, path):
-    if os.path.exists(path):
-      return os.path.getmtime(path)
-    return None
-
-
-fileCopyCache = FileCopyCache()
-
 # Runs a shell command
 class ShellScript(object):
   def __init__(self, commandText, cwd):
@@ -185,15 +238,12 @@ class ShellScript(object):
   def process(self):
     cwd = self.cwd
     print("Running '" + self.commandText + "' in " + cwd)
-    try:
-      subprocess.check_call(["bash", "-c", "cd " + cwd + " && " + self.commandText])
-      return 0
-    except subprocess.CalledProcessError as e:
-      return e.returncode
+    # Passing cwd to subprocess (rather than prepending "cd <cwd> &&" to the command) means that cwd doesn't need any quoting
+    return subprocess.call(self.commandText, shell=True, cwd=cwd, executable="bash")
 
 # Base class that can hold the state of a file
 class FileContent(object):
-  def apply(self, filePath, cachePath=None):
+  def apply(self, filePath):
     pass
 
   def equals(self, other, checkWithFileSystem=False):
@@ -201,17 +251,36 @@ class FileContent(object):
 
 # A FileContent that refers to the content of a specific file
 class FileBacked_FileContent(FileContent):
-  def __init__(self, referencePath):
+  # <isLink> can be passed by callers that already know whether <referencePath> is a symlink, to save an lstat()
+  def __init__(self, referencePath, isLink=None):
     super(FileBacked_FileContent, self).__init__()
     self.referencePath = referencePath
-    self.isLink = os.path.islink(self.referencePath)
-
-  def apply(self, filePath, cachePath=None):
-    fileCopyCache.copyFile(self.referencePath, filePath, cachePath)
+    if isLink is None:
+      isLink = os.path.islink(self.referencePath)
+    self.isLink = isLink
+    # the size of this file and a hash of its content, each computed when first needed
+    self.size = None
+    self.digest = None
+
+  def getSize(self):
+    if self.size is None:
+      self.size = os.lstat(self.referencePath).st_size
+    return self.size
+
+  def getDigest(self):
+    if self.digest is None:
+      self.digest = fileIo.hashFile(self.referencePath)
+    return self.digest
+
+  def apply(self, filePath):
+    fileIo.copyFile(self.referencePath, filePath)
 
   def equals(self, other, checkWithFileSystem=False):
+    if self is other:
+      return True
     if not isinstance(other, FileBacked_FileContent):
       return False
+    # referencePaths are interned when possible, and comparing a string to itself only compares pointers
     if self.referencePath == other.referencePath:
       return True
     if not checkWithFileSystem:
@@ -220,7 +289,10 @@ class FileBacked_FileContent(FileContent):
       return os.readlink(self.referencePath) == os.readlink(other.referencePath)
     if self.isLink != other.isLink:
       return False # symlink not equal to non-symlink
-    return filecmp.cmp(self.referencePath, other.referencePath)
+    # checking the sizes first lets us skip reading files having different sizes
+    if self.getSize() != other.getSize():
+      return False
+    return self.getDigest() == other.getDigest()
 
   def __str__(self):
     return self.referencePath
@@ -230,44 +302,131 @@ class MissingFile_FileContent(FileContent):
   def __init__(self):
     super(MissingFile_FileContent, self).__init__()
 
-  def apply(self, filePath, cachePath=None):
+  def apply(self, filePath):
     fileIo.removePath(filePath)
 
   def equals(self, other, checkWithFileSystem=False):
-    return isinstance(other, MissingFile_FileContent)
+    # usually <other> is the shared instance, unless it was copied from another process
+    return other is self or isinstance(other, MissingFile_FileContent)
 
   def __str__(self):
     return "Empty"
 
+# FileContents have no per-instance state except for FileBacked_FileContent, so we share the other ones
+missingFileContent = MissingFile_FileContent()
+
 # A FileContent describing a directory
 class Directory_FileContent(FileContent):
   def __init__(self):
     super(Directory_FileContent, self).__init__()
 
-  def apply(self, filePath, cachePath=None):
+  def apply(self, filePath):
     fileIo.ensureDirExists(filePath)
 
   def equals(self, other, checkWithFileSystem=False):
-    return isinstance(other, Directory_FileContent)
+    return other is self or isinstance(other, Directory_FileContent)
 
   def __str__(self):
     return "[empty dir]"
 
+directoryContent = Directory_FileContent()
+
+# Cache of the results of getParentDir, because we ask about the same paths many times
+parentDirsByPath = {}
+
+# returns the path of the directory containing <path>, or "." if <path> is a top-level path
+def getParentDir(path):
+  parent = parentDirsByPath.get(path)
+  if parent is None:
+    parent = os.path.dirname(path)
+    if parent == "":
+      parent = "."
+    parentDirsByPath[path] = parent
+  return parent
+
 # A collection of many FileContent objects
 class FilesState(object):
   def __init__(self):
-    self.fileStates = OrderedDict()
-
-  def apply(self, filePath, cachePath=None):
+    # dicts preserve insertion order (as of Python 3.7)
+    self.fileStates = {}
+    # the result of listImpliedDirs, or None if it hasn't been computed since the last change
+    self.impliedDirs = None
+
+  def apply(self, filePath):
+    # We apply our changes in batches:
+    # First we remove anything that shouldn't exist, so that it can't get in the way of anything we create
+    # Then we make each needed directory, once per directory rather than once per file
+    # Then we put the files in place
+    removals = []
+    dirPaths = set()
+    files = []
     for relPath, state in self.fileStates.items():
-      state.apply(fileIo.join(filePath, relPath), cachePath)
+      if isinstance(state, MissingFile_FileContent):
+        removals.append((relPath, state))
+      elif isinstance(state, Directory_FileContent):
+        dirPaths.add(relPath)
+      else:
+        dirPaths.add(getParentDir(relPath))
+        files.append((relPath, state))
+    fileIo.beginBatch()
+    try:
+      for relPath, state in removals:
+        state.apply(fileIo.join(filePath, relPath))
+      for relPath in dirPaths:
+        fileIo.ensureDirExists(fileIo.join(filePath, relPath))
+      for relPath, state in files:
+        state.apply(fileIo.join(filePath, relPath))
+    finally:
+      fileIo.endBatch()
 
   def add(self, filePath, fileContent):
+    previousContent = self.fileStates.get(filePath)
     self.fileStates[filePath] = fileContent
+    self.updateImpliedDirs(filePath, previousContent, fileContent)
+
+  def remove(self, filePath):
+    if filePath in self.fileStates:
+      previousContent = self.fileStates.pop(filePath)
+      self.updateImpliedDirs(filePath, previousContent, None)
+
+  # updates our cached implied dirs (if any) after the content at <filePath> changes from <previousContent> to <newContent>
+  def updateImpliedDirs(self, filePath, previousContent, newContent):
+    if self.impliedDirs is None:
+      return
+    if newContent is None or isinstance(newContent, MissingFile_FileContent):
+      if previousContent is not None and not isinstance(previousContent, MissingFile_FileContent):
+        # this path might have been the only one implying some dirs, so we'll have to recompute them
+        self.impliedDirs = None
+    else:
+      parent = getParentDir(filePath)
+      while parent not in self.impliedDirs:
+        self.impliedDirs.add(parent)
+        parent = getParentDir(parent)
+
+  # updates <self> to contain the entries of <other>, removing any paths for which <other> has an empty entry
+  def applyDelta(self, other):
+    for filePath, fileContent in other.fileStates.items():
+      if isinstance(fileContent, MissingFile_FileContent):
+        self.remove(filePath)
+      else:
+        self.add(filePath, fileContent)
+
+  # replaces the contents of <self> with the given dict of paths to FileContents
+  # This is faster than calling add() for each entry
+  def setFileStates(self, fileStates):
+    self.fileStates = fileStates
+    self.impliedDirs = None
 
   def addAllFrom(self, other):
-    for filePath in other.fileStates:
-        self.add(filePath, other.fileStates[filePath])
+    self.addEntries(other.fileStates)
+
+  # adds each entry of <fileStates> (a dict of paths to FileContents) to <self>
+  # This is faster than calling add() for each entry
+  def addEntries(self, fileStates):
+    if self.impliedDirs is not None:
+      for filePath, fileContent in fileStates.items():
+        self.updateImpliedDirs(filePath, self.fileStates.get(filePath), fileContent)
+    self.fileStates.update(fileStates)
 
   def getContent(self, filePath):
     if filePath in self.fileStates:
@@ -280,40 +439,55 @@ class FilesState(object):
   # returns a FilesState resembling <self> but without the keys for which other[key] == self[key]
   def withoutDuplicatesFrom(self, other, checkWithFileSystem=False):
     result = FilesState()
-    for filePath, fileState in self.fileStates.items():
-      otherContent = other.getContent(filePath)
-      if not fileState.equals(otherContent, checkWithFileSystem):
-        result.add(filePath, fileState)
+    otherStates = other.fileStates
+    result.setFileStates({filePath: fileState for filePath, fileState in self.fileStates.items() if not fileState.equals(otherStates.get(filePath), checkWithFileSystem)})
+    return result
+
+  # updates <self> to match self.expandedWithEmptyEntriesFor(other).withConflictsFrom(other)
+  # Merging many FilesStates this way copies each entry once rather than once per merge
+  def mergeFrom(self, other):
+    impliedDirs = self.listImpliedDirs()
+    selfStates = self.fileStates
+    self.addEntries({filePath: fileContent for filePath, fileContent in other.fileStates.items() if filePath in selfStates or filePath not in impliedDirs})
+
+  # returns the entries that need to be applied to a directory matching <other> to make it match <self>
+  # This matches self.expandedWithEmptyEntriesFor(other).withoutDuplicatesFrom(other) but doesn't first copy all of our entries
+  def changesFrom(self, other, checkWithFileSystem=False):
+    result = FilesState()
+    selfStates = self.fileStates
+    otherStates = other.fileStates
+    changes = {filePath: fileState for filePath, fileState in selfStates.items() if not fileState.equals(otherStates.get(filePath), checkWithFileSystem)}
+    impliedDirs = self.listImpliedDirs()
+    for filePath, fileState in otherStates.items():
+      if filePath not in selfStates and filePath not in impliedDirs and not missingFileContent.equals(fileState):
+        changes[filePath] = missingFileContent
+    result.setFileStates(changes)
     return result
 
   # returns self[fromIndex:toIndex]
   def slice(self, fromIndex, toIndex):
     result = FilesState()
-    for filePath in list(self.fileStates.keys())[fromIndex:toIndex]:
-      result.fileStates[filePath] = self.fileStates[filePath]
+    # skipping to the entries we need avoids copying all of our keys into a list first
+    result.setFileStates(dict(itertools.islice(self.fileStates.items(), fromIndex, toIndex)))
     return result
 
   def restrictedToKeysIn(self, other):
     result = FilesState()
-    for filePath, fileState in self.fileStates.items():
-      if filePath in other.fileStates:
-        result.add(filePath, fileState)
+    otherStates = other.fileStates
+    result.setFileStates({filePath: fileState for filePath, fileState in self.fileStates.items() if filePath in otherStates})
     return result
 
   # returns a FilesState having the same keys as this FilesState, but with values taken from <other> when it has them, and <self> otherwise
   def withConflictsFrom(self, other, listEmptyDirs = False):
     result = FilesState()
-    for filePath, fileContent in self.fileStates.items():
-      if filePath in other.fileStates:
-        result.add(filePath, other.fileStates[filePath])
-      else:
-        result.add(filePath, fileContent)
+    otherStates = other.fileStates
+    result.setFileStates({filePath: otherStates.get(filePath, fileContent) for filePath, fileContent in self.fileStates.items()})
     if listEmptyDirs:
       oldImpliedDirs = self.listImpliedDirs()
       newImpliedDirs = result.listImpliedDirs()
       for impliedDir in oldImpliedDirs:
         if impliedDir not in newImpliedDirs and impliedDir not in result.fileStates:
-          result.add(impliedDir, MissingFile_FileContent())
+          result.add(impliedDir, missingFileContent)
     return result
 
   def checkSameKeys(self, other):
@@ -336,20 +510,20 @@ class FilesState(object):
     return contains
 
   # returns a set of paths to all of the dirs in <self> that are implied by any files in <self>
+  # The returned set is kept up to date as entries are added, so callers must not modify it
   def listImpliedDirs(self):
+    if self.impliedDirs is not None:
+      return self.impliedDirs
     dirs = set()
-    empty = MissingFile_FileContent()
-    keys = [key for (key, value) in self.fileStates.items() if not empty.equals(value)]
-    i = 0
-    while i < len(keys):
-      path = keys[i]
-      parent, child = os.path.split(path)
-      if parent == "":
-        parent = "."
-      if not parent in dirs:
+    for path, content in self.fileStates.items():
+      if missingFileContent.equals(content):
+        continue
+      # add each ancestor of this path, stopping once we reach one that we've already added (along with its ancestors)
+      parent = getParentDir(path)
+      while parent not in dirs:
         dirs.add(parent)
-        keys.append(parent)
-      i += 1
+        parent = getParentDir(parent)
+    self.impliedDirs = dirs
     return dirs
 
   # returns a FilesState having all of the entries from <self>, plus empty entries for any keys in <other> not in <self>
@@ -357,23 +531,21 @@ class FilesState(object):
     impliedDirs = self.listImpliedDirs()
     # now look for entries in <other> not present in <self>
     result = self.clone()
-    for filePath in other.fileStates:
-      if filePath not in result.fileStates and filePath not in impliedDirs:
-        result.fileStates[filePath] = MissingFile_FileContent()
+    selfStates = self.fileStates
+    result.addEntries({filePath: missingFileContent for filePath in other.fileStates if filePath not in selfStates and filePath not in impliedDirs})
     return result
 
   def clone(self):
     result = FilesState()
-    for path, content in self.fileStates.items():
-      result.add(path, content)
+    result.fileStates = dict(self.fileStates)
+    if self.impliedDirs is not None:
+      # we update our implied dirs in place, so each FilesState needs its own copy
+      result.impliedDirs = set(self.impliedDirs)
     return result
 
   def withoutEmptyEntries(self):
     result = FilesState()
-    empty = MissingFile_FileContent()
-    for path, state in self.fileStates.items():
-      if not empty.equals(state):
-        result.add(path, state)
+    result.setFileStates({path: state for path, state in self.fileStates.items() if not missingFileContent.equals(state)})
     return result
 
   def getCommonDir(self):
@@ -396,19 +568,25 @@ class FilesState(object):
     groupsByDir = {}
 
     for filePath, fileContent in self.fileStates.items():
-      subPath = filePath[prefixLength:]
-      slashIndex = subPath.find("/")
+      # searching from prefixLength lets us avoid copying the rest of filePath before searching it
+      slashIndex = filePath.find("/", prefixLength)
       if slashIndex < 0:
         if groupDirectFilesTogether:
           firstDir = ""
         else:
-          firstDir = subPath
+          firstDir = filePath[prefixLength:]
       else:
-        firstDir = subPath[:slashIndex]
-      if not firstDir in groupsByDir:
-        groupsByDir[firstDir] = FilesState()
-      groupsByDir[firstDir].add(filePath, fileContent)
-    return [group for group in groupsByDir.values()]
+        firstDir = filePath[prefixLength:slashIndex]
+      group = groupsByDir.get(firstDir)
+      if group is None:
+        group = groupsByDir[firstDir] = {}
+      group[filePath] = fileContent
+    groups = []
+    for fileStates in groupsByDir.values():
+      group = FilesState()
+      group.setFileStates(fileStates)
+      groups.append(group)
+    return groups
 
   # splits into multiple, smaller, FilesState objects
   def splitOnce(self, maxNumChildren = 2):
@@ -456,58 +634,128 @@ class FilesState(object):
       prefix = "1 entry: "
     return prefix + "\n".join(entries)
 
+# Lists the directory at <dirPath>, whose path relative to the root of the tree being scanned is <relPath>
+# Adds an entry into <states> for each leaf in the directory (or for the directory itself, if it is empty)
+# Returns a list of (path, relPath) for each subdirectory, which the caller is responsible for scanning
+def scanDir(dirPath, relPath, states):
+  try:
+    entries = list(os.scandir(dirPath))
+  except OSError:
+    # like os.walk, we skip any directories we can't list
+    return []
+  if len(entries) == 0:
+    states[relPath] = directoryContent
+  subdirs = []
+  for entry in entries:
+    # We intern paths so that comparing equal paths later is just a pointer comparison
+    if relPath == ".":
+      childRelPath = sys.intern(entry.name)
+    else:
+      childRelPath = sys.intern(relPath + "/" + entry.name)
+    # include every file and every symlink (even if the symlink points to a dir)
+    # DirEntry caches the file type reported when listing the directory, so this doesn't need another stat()
+    if entry.is_dir(follow_symlinks=False):
+      subdirs.append((entry.path, childRelPath))
+    else:
+      states[childRelPath] = FileBacked_FileContent(sys.intern(entry.path), entry.is_symlink())
+  return subdirs
+
+# Returns a dict of the FileContents in the tree at <dirPath>, keyed by their paths relative to the root of the tree being scanned
+def scanTree(dirPath, relPath):
+  states = {}
+  pending = [(dirPath, relPath)]
+  while len(pending) > 0:
+    dirPath, relPath = pending.pop()
+    pending += scanDir(dirPath, relPath, states)
+  return states
+
 # Creates a FilesState matching the state of a directory on disk
 def filesStateFromTree(rootPath):
   rootPath = os.path.abspath(rootPath)
 
-  paths = []
   states = {}
+  subdirs = scanDir(rootPath, ".", states)
+  # Scanning mostly waits on the filesystem, so we scan the top-level directories in parallel
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    for subdirStates in executor.map(lambda subdir: scanTree(*subdir), subdirs):
+      states.update(subdirStates)
 
-  for root, dirPaths, filePaths in os.walk(rootPath, topdown=True):
-    if len(filePaths) == 0 and len(dirPaths) == 0:
-      relPath = os.path.relpath(root, rootPath)
-      paths.append(relPath)
-      states[relPath] = Directory_FileContent()
-    # include every file and every symlink (even if the symlink points to a dir)
-    leaves = filePaths
-    for dirPath in dirPaths:
-      fullPath = os.path.join(root, dirPath)
-      if os.path.islink(fullPath):
-        leaves.append(dirPath)
-    for filePath in leaves:
-      fullPath = fileIo.join(root, filePath)
-      relPath = os.path.relpath(fullPath, rootPath)
-      paths.append(relPath)
-      states[relPath] = FileBacked_FileContent(fullPath)
-
-  paths = sorted(paths)
+  # The paths are already unique (they are dict keys), so we only need to sort them
   state = FilesState()
-  for path in paths:
-    state.add(path, states[path])
+  state.setFileStates({path: states[path] for path in sorted(states)})
   return state
 
-# runs a Job in this process
-def runJobInSameProcess(shellCommand, workPath, cachePath, originalState, assumeNoSideEffects, full_resetTo_state, testState, twoWayPipe):
-  job = Job(shellCommand, workPath, cachePath, originalState, assumeNoSideEffects, full_resetTo_state, testState, twoWayPipe)
-  job.runAndReport()
-
-# starts a Job in a new process
-def runJobInOtherProcess(shellCommand, workPath, cachePath, originalState, assumeNoSideEffects, full_resetTo_state, testState, queue, identifier):
-  parentWriter, childReader = multiprocessing.Pipe()
-  childInfo = TwoWayPipe(childReader, queue, identifier)
-  process = multiprocessing.Process(target=runJobInSameProcess, args=(shellCommand, workPath, cachePath, originalState, assumeNoSideEffects, full_resetTo_state, testState, childInfo,))
-  process.start()
-  return parentWriter
-
-class TwoWayPipe(object):
-  def __init__(self, readerConnection, writerQueue, identifier):
-    self.readerConnection = readerConnection
-    self.writerQueue = writerQueue
+# the multiprocessing context that we start workers with, or None if we haven't needed it yet
+processContext = None
+
+# We prefer fork so that each child process inherits the (potentially large) FilesState objects it needs from our memory
+# rather than receiving a pickled copy of them, which is what the spawn and forkserver start methods would require
+# Some platforms (such as Windows) don't support fork, so there we use the default start method
+def getProcessContext():
+  global processContext
+  if processContext is None:
+    if "fork" in multiprocessing.get_all_start_methods():
+      processContext = multiprocessing.get_context("fork")
+    else:
+      processContext = multiprocessing.get_context()
+  return processContext
+
+# Repeatedly receives Jobs from <jobQueue> and runs them in this process, until it receives None
+def runWorker(identifier, shellCommand, workPath, assumeNoSideEffects, full_resetTo_state, jobQueue, resultQueue):
+  # the state of our working directory
+  workerState = FilesState()
+  while True:
+    message = jobQueue.get()
+    if message is None:
+      return
+    resetTo_updates, testState = message
+    try:
+      # catch up on any changes to the best accepted state since our previous job
+      for update in resetTo_updates:
+        full_resetTo_state.applyDelta(update)
+      job = Job(shellCommand, workPath, workerState, assumeNoSideEffects, full_resetTo_state, testState, resultQueue, identifier)
+    except Exception as e:
+      # We no longer know whether full_resetTo_state is correct, so we can't run any more tests
+      # Reporting a result of None asks our parent to retry this test in a new worker
+      print("Job " + str(identifier) + " could not prepare its test: " + str(e))
+      sys.stdout.flush()
+      resultQueue.put((identifier, None))
+      return
+    try:
+      workerState = job.runAndReport()
+    except Exception as e:
+      print("Job " + str(identifier) + " encountered an error: " + str(e))
+      sys.stdout.flush()
+      # we no longer know what's in our working directory, so we clear it
+      fileIo.removePath(workPath)
+      workerState = FilesState()
+
+# A process that runs Jobs, one at a time
+# Reusing the same process for multiple Jobs saves us from starting a new process for each test
+class Worker(object):
+  def __init__(self, identifier, shellCommand, workPath, assumeNoSideEffects, full_resetTo_state, numResetTo_updates, resultQueue):
     self.identifier = identifier
+    # A SimpleQueue writes each message immediately rather than starting a feeder thread to write it
+    # This way we don't have any other threads running when we fork the next worker
+    self.jobQueue = getProcessContext().SimpleQueue()
+    # the number of updates to full_resetTo_state that this worker already knows about
+    self.numResetTo_updates = numResetTo_updates
+    self.process = getProcessContext().Process(target=runWorker, args=(identifier, shellCommand, workPath, assumeNoSideEffects, full_resetTo_state, self.jobQueue, resultQueue,))
+    self.process.daemon = True
+    self.process.start()
+
+  # asks this worker to test <testState>, informing it of any of <resetTo_updates> that it hasn't yet seen
+  def startJob(self, testState, resetTo_updates):
+    self.jobQueue.put((resetTo_updates[self.numResetTo_updates:], testState))
+    self.numResetTo_updates = len(resetTo_updates)
+
+  def stop(self):
+    self.jobQueue.put(None)
+    self.process.join()
 
 # Stores a subprocess for running tests and some information about which tests to run
 class Job(object):
-  def __init__(self, shellCommand, workPath, cachePath, originalState, assumeNoSideEffects, full_resetTo_state, testState, twoWayPipe):
+  def __init__(self, shellCommand, workPath, originalState, assumeNoSideEffects, full_resetTo_state, testState, resultQueue, identifier):
     # the test to run
     self.shellCommand = shellCommand
     # directory to run the test in
@@ -520,28 +768,34 @@ class Job(object):
     self.full_resetTo_state = full_resetTo_state
     # the changes we're considering
     self.testState = testState
-    self.pipe = twoWayPipe
-    self.cachePath = cachePath
+    self.resultQueue = resultQueue
+    self.identifier = identifier
 
+  # runs the test, reports whether it passed, and returns the resulting state of the working directory
   def runAndReport(self):
     succeeded = False
-    postState = None
     try:
       (succeeded, postState) = self.run()
     finally:
       print("^" * 100)
-      self.pipe.writerQueue.put((self.pipe.identifier, succeeded, postState))
+      # This process keeps running after the test, so we flush our output now rather than when the process exits
+      # Otherwise, if stdout is a pipe, our output would be held back and shown out of order with our parent's
+      sys.stdout.flush()
+      self.resultQueue.put((self.identifier, succeeded))
+    return postState
 
   def run(self):
     print("#" * 100)
-    print("Checking " + self.testState.summarize() + " (job " + str(self.pipe.identifier) + ") in " + str(self.workPath) + " at " + str(datetime.datetime.now()))
+    print("Checking " + self.testState.summarize() + " (job " + str(self.identifier) + ") in " + str(self.workPath) + " at " + str(datetime.datetime.now()))
 
     # compute the state that we want the files to be in before we start the test
     fullStateToTest = self.full_resetTo_state.expandedWithEmptyEntriesFor(self.testState).withConflictsFrom(self.testState, True)
     #print("Starting with original worker state of " + str(self.originalState))
 
     # update our files on disk to match the state we want to test
-    fullStateToTest.expandedWithEmptyEntriesFor(self.originalState).withoutDuplicatesFrom(self.originalState).apply(self.workPath)
+    # Each file gets its own copy (reflinked where the filesystem supports it) rather than a hardlink to a shared copy,
+    # so that the test can't change the permissions or content of any other file by modifying this one
+    fullStateToTest.changesFrom(self.originalState).apply(self.workPath)
 
     # run test
     testStartSeconds = time.time()
@@ -559,26 +813,62 @@ class Job(object):
       for key in postState.getKeys():
         modified = postState.getContent(key)
         if isinstance(modified, FileBacked_FileContent):
+          # We need one stat() here anyway (scandir doesn't report mtimes on Linux), so we also save the size that it reports
+          # (A symlink's own mtime tells whether the link itself changed, and its size is what FileBacked_FileContent compares)
+          fileStat = os.lstat(modified.referencePath)
+          modified.size = fileStat.st_size
           # If any filepath wasn't modified since the start of the test, then its content matches the original
           # (If the content is known to match the original, we won't have to reset it next time)
-          if os.path.getmtime(modified.referencePath) < testStartSeconds:
+          if fileStat.st_mtime < testStartSeconds:
             original = fullStateToTest.getContent(key)
             if original is not None:
               if isinstance(original, FileBacked_FileContent):
                 modified.referencePath = original.referencePath
+                modified.digest = original.digest
 
     # report results
     if returnCode == 0:
-      print("Passed: " + self.testState.summarize() + " (job " + str(self.pipe.identifier) + ") at " + str(datetime.datetime.now()) + " in " + str(duration))
+      print("Passed: " + self.testState.summarize() + " (job " + str(self.identifier) + ") at " + str(datetime.datetime.now()) + " in " + str(duration))
       return (True, postState)
     else:
-      print("Failed: " + self.testState.summarize() + " (job " + str(self.pipe.identifier) + ") at " + str(datetime.datetime.now()) + " in " + str(duration))
+      print("Failed: " + self.testState.summarize() + " (job " + str(self.identifier) + ") at " + str(datetime.datetime.now()) + " in " + str(duration))
       return (False, postState)
 
 
+# Holds FilesStates that are waiting to be tested, and returns the largest ones first
+# FilesStates of equal size are returned in the order they were added, like a stable sort would do
+class TestStateQueue(object):
+  def __init__(self, states=()):
+    # entries are (-size, order, state) so that the largest, earliest added states are at the top of the heap
+    self.heap = []
+    self.counter = itertools.count()
+    self.numAddedFirst = 0
+    self.addAll(states)
+
+  def add(self, state):
+    heapq.heappush(self.heap, (-state.size(), next(self.counter), state))
+
+  def addAll(self, states):
+    for state in states:
+      self.add(state)
+
+  # adds <state> ahead of any other states of the same size
+  def addFirst(self, state):
+    self.numAddedFirst += 1
+    heapq.heappush(self.heap, (-state.size(), -self.numAddedFirst, state))
+
+  def pop(self):
+    return heapq.heappop(self.heap)[2]
+
+  def getStates(self):
+    return [entry[2] for entry in self.heap]
+
+  def __len__(self):
+    return len(self.heap)
+
 # Runner class that determines which diffs between two directories cause the given shell command to fail
 class DiffRunner(object):
-  def __init__(self, failingPath, passingPath, shellCommand, workPath, assumeNoSideEffects, assumeInputStatesAreCorrect, maxNumJobsAtOnce, timeoutSeconds):
+  def __init__(self, failingPath, passingPath, shellCommand, workPath, assumeNoSideEffects, assumeInputStatesAreCorrect, maxNumJobsAtOnce, splitRunningJobs, timeoutSeconds):
     # some simple params
     self.workPath = os.path.abspath(workPath)
     self.bestState_path = fileIo.join(self.workPath, "bestResults")
@@ -590,6 +880,7 @@ class DiffRunner(object):
     self.originalFailingPath = os.path.abspath(failingPath)
     self.assumeNoSideEffects = assumeNoSideEffects
     self.assumeInputStatesAreCorrect = assumeInputStatesAreCorrect
+    self.splitRunningJobs = splitRunningJobs
     self.timeoutSeconds = timeoutSeconds
 
     # lists of all the files under the two dirs
@@ -603,13 +894,16 @@ class DiffRunner(object):
     print("")
     print("Identifying duplicates")
     # list of the files in the state to reset to after each test
-    self.full_resetTo_state = self.originalPassingState
+    # This gets updated in place, so it is a copy rather than the same object as originalPassingState
+    self.full_resetTo_state = self.originalPassingState.clone()
     # minimal description of only the files that are supposed to need to be reset after each test
-    self.resetTo_state = self.originalPassingState.expandedWithEmptyEntriesFor(self.originalFailingState).withoutDuplicatesFrom(self.originalFailingState, True)
-    self.targetState = self.originalFailingState.expandedWithEmptyEntriesFor(self.originalPassingState).withoutDuplicatesFrom(self.originalPassingState, True)
+    self.resetTo_state = self.originalPassingState.changesFrom(self.originalFailingState, True)
+    self.targetState = self.originalFailingState.changesFrom(self.originalPassingState, True)
     self.originalNumDifferences = self.resetTo_state.size()
     print("Processing " + str(self.originalNumDifferences) + " file differences")
     self.maxNumJobsAtOnce = maxNumJobsAtOnce
+    # the deltas that have been merged into full_resetTo_state, in order, so that workers can keep their copies up to date
+    self.resetTo_updates = []
 
   def cleanupTempDirs(self):
     print("Clearing work directories")
@@ -624,7 +918,6 @@ class DiffRunner(object):
             except IOError as e:
               if attempt >= numAttempts - 1:
                 raise Exception("Failed to remove " + path, e)
-    fileIo.removePath(os.path.join(self.workPath, "caches"))
 
   def runnerTest(self, testState, timeout = None):
     workPath = self.getWorkPath(0)
@@ -644,7 +937,8 @@ class DiffRunner(object):
       return (False, duration)
 
   def onSuccess(self, testState):
-    #print("Runner received success of testState: " + str(testState.summarize()))
+    if debug:
+      print("Runner received success of testState: " + str(testState.summarize()))
     if debug:
       if not filesStateFromTree(self.bestState_path).checkSameKeys(self.full_resetTo_state.withoutEmptyEntries()):
         print("Contents of " + self.bestState_path + " don't match self.full_resetTo_state at beginning of onSuccess")
@@ -653,19 +947,24 @@ class DiffRunner(object):
     self.resetTo_state = self.resetTo_state.withConflictsFrom(testState).withoutDuplicatesFrom(testState)
     delta = self.full_resetTo_state.expandedWithEmptyEntriesFor(testState).withConflictsFrom(testState, True).withoutDuplicatesFrom(self.full_resetTo_state)
     delta.apply(self.bestState_path)
-    self.full_resetTo_state = self.full_resetTo_state.expandedWithEmptyEntriesFor(delta).withConflictsFrom(delta)
+    self.full_resetTo_state.applyDelta(delta)
+    self.resetTo_updates.append(delta)
     if debug:
       if not filesStateFromTree(self.bestState_path).checkSameKeys(self.full_resetTo_state.withoutEmptyEntries()):
         print("Contents of " + self.bestState_path + " don't match self.full_resetTo_state at end of onSuccess")
         print("Applied this delta: " + str(delta))
         sys.exit(1)
 
+  # returns a value identifying the test of <testState> applied to the current full_resetTo_state
+  # Two tests having the same key test the same files, so (assuming that the test is deterministic) they have the same result
+  def getTestKey(self, testState):
+    # full_resetTo_state is determined by the number of updates that have been applied to it
+    # FileContent objects compare by identity here, which can miss some equivalent tests but never matches different ones
+    return (len(self.resetTo_updates), frozenset(testState.fileStates.items()))
+
   def getWorkPath(self, jobId):
     return os.path.join(self.workPath, "job-" + str(jobId))
 
-  def getFilesCachePath(self, jobId):
-    return os.path.join(self.workPath, "caches", "job-" + str(jobId))
-
   def run(self):
     start = datetime.datetime.now()
     numIterationsCompleted = 0
@@ -697,13 +996,16 @@ class DiffRunner(object):
     # If it doesn't, we split that group into smaller groups and continue
     jobId = 0
     workingDir = self.getWorkPath(jobId)
-    queue = multiprocessing.Queue()
+    queue = getProcessContext().Queue()
     activeTestStatesById = {}
-    workerStatesById = {}
+    workersById = {}
+    # ids less than numJobIds that aren't in use, in a heap so that we reuse the smallest ones (and their workers) first
+    freeJobIds = []
+    numJobIds = 0
     initialSplitSize = 2
     if self.maxNumJobsAtOnce != "auto" and self.maxNumJobsAtOnce > 2:
       initialSplitSize = self.maxNumJobsAtOnce
-    availableTestStates = self.targetState.splitOnce(initialSplitSize)
+    availableTestStates = TestStateQueue(self.targetState.splitOnce(initialSplitSize))
     numConsecutiveFailures = 0
     numFailuresSinceLastSplitOrSuccess = 0
     numCompletionsSinceLastPoolSizeChange = 0
@@ -712,22 +1014,44 @@ class DiffRunner(object):
     numCompletedTests = 2 # Already tested initial passing state and initial failing state
     numJobsAtFirstSuccessAfterMerge = None
     timedOut = False
+    # responses that we have received but not yet processed
+    receivedResponses = []
+    # the result of getTestKey for each active job
+    testKeysById = {}
+    # the result of getTestKey for each test that failed
+    failedTestKeys = set()
+    # ids of active jobs whose states were already split up and queued while they were still running
+    splitActiveIds = set()
+    # when each active job (that is actually running a test) started, according to time.monotonic()
+    jobStartTimesById = {}
+    # the total duration and number of tests that we've timed, so we know how long a test usually takes
+    totalTestSeconds = 0
+    numTimedTests = 0
+    # when the next running job will have run long enough to be worth splitting to use an idle job slot, or None
+    nextSplitTime = None
+    # when we last displayed a status message
+    lastStatusTime = None
     # continue until all files fail and no jobs are running
     while (numFailuresSinceLastSplitOrSuccess < self.resetTo_state.size() and not timedOut) or len(activeTestStatesById) > 0:
-      # display status message
       now = datetime.datetime.now()
       elapsedDuration = now - start
-      minNumTestsRemaining = sum([math.log(box.size(), 2) + 1 for box in availableTestStates + list(activeTestStatesById.values())]) - numFailuresSinceLastSplitOrSuccess
-      estimatedNumTestsRemaining = max(minNumTestsRemaining, 1)
-      if numConsecutiveFailures >= 4 and numFailuresSinceLastSplitOrSuccess < 1:
-        # If we are splitting often and failing often, then we probably haven't yet
-        # shrunken the individual boxes down to each contain only one failing file
-        # During this phase, on average we've completed half of the work
-        # So, we estimate that the total work remaining is double what we've completed
-        estimatedNumTestsRemaining *= 2
-      estimatedRemainingDuration = datetime.timedelta(seconds = elapsedDuration.total_seconds() * float(estimatedNumTestsRemaining) / float(numCompletedTests))
-      message = "Elapsed duration: " + str(elapsedDuration) + ". Waiting for " + str(len(activeTestStatesById)) + " active subprocesses (" + str(len(availableTestStates) + len(activeTestStatesById)) + " total available jobs). " + str(self.resetTo_state.size()) + " changes left to test, should take about " + str(estimatedNumTestsRemaining) + " tests, about " + str(estimatedRemainingDuration)
-      print(message)
+      # display a status message if we're about to wait for a job to finish
+      # (If responses are already waiting, then we process them all before reporting status or starting more jobs)
+      # If tests are fast, then we only display it occasionally, because computing it involves checking every pending state
+      if len(receivedResponses) < 1 and (lastStatusTime is None or (now - lastStatusTime).total_seconds() >= 1):
+        lastStatusTime = now
+        minNumTestsRemaining = sum([math.log(box.size(), 2) + 1 for box in availableTestStates.getStates() + list(activeTestStatesById.values())]) - numFailuresSinceLastSplitOrSuccess
+        estimatedNumTestsRemaining = max(minNumTestsRemaining, 1)
+        if numConsecutiveFailures >= 4 and numFailuresSinceLastSplitOrSuccess < 1:
+          # If we are splitting often and failing often, then we probably haven't yet
+          # shrunken the individual boxes down to each contain only one failing file
+          # During this phase, on average we've completed half of the work
+          # So, we estimate that the total work remaining is double what we've completed
+          estimatedNumTestsRemaining *= 2
+        estimatedRemainingDuration = datetime.timedelta(seconds = elapsedDuration.total_seconds() * float(estimatedNumTestsRemaining) / float(numCompletedTests))
+        message = "Elapsed duration: " + str(elapsedDuration) + ". Waiting for " + str(len(activeTestStatesById)) + " active subprocesses (" + str(len(availableTestStates) + len(activeTestStatesById)) + " total available jobs). " + str(self.resetTo_state.size()) + " changes left to test, should take about " + str(estimatedNumTestsRemaining) + " tests, about " + str(estimatedRemainingDuration)
+        print(message)
+
       if self.timeoutSeconds is not None:
         # what fraction of the time is left
         remainingTimeFraction = 1.0 - (elapsedDuration.total_seconds() / self.timeoutSeconds)
@@ -737,20 +1061,36 @@ class DiffRunner(object):
           # adding one more job would be likely to cause us to exceed our time limit
           timedOut = True
 
-      if len(activeTestStatesById) > 0:
+      if len(activeTestStatesById) > 0 and len(receivedResponses) < 1:
         # wait for a response from a worker
-        identifier, didAcceptState, workerNewState = queue.get()
+        # If a running job could be split to use an idle job slot, then we only wait until that job has run long enough
+        try:
+          if nextSplitTime is None:
+            receivedResponses.append(queue.get())
+          else:
+            receivedResponses.append(queue.get(timeout=max(nextSplitTime - time.monotonic(), 0)))
+        except Empty:
+          pass
+      if len(receivedResponses) > 0:
+        identifier, didAcceptState = receivedResponses.pop(0)
         box = activeTestStatesById[identifier]
-        #print("main process received worker new state of " + str(workerNewState))
-        workerStatesById[identifier] = workerNewState
+        if identifier in jobStartTimesById:
+          totalTestSeconds += time.monotonic() - jobStartTimesById.pop(identifier)
+          numTimedTests += 1
         numCompletedTests += 1
         numCompletionsSinceLastPoolSizeChange += 1
-        if didAcceptState:
+        if didAcceptState is None:
+          # the worker couldn't run this test and has stopped, so we'll run it again in a new worker
+          print("Job " + str(identifier) + " did not run its test; queuing it again")
+          workersById.pop(identifier).process.join()
+          availableTestStates.addFirst(box)
+        elif didAcceptState:
           numConsecutiveFailures = 0
           numFailuresSinceLastSplitOrSuccess = 0
           acceptedState = box #.getAllFiles()
-          #print("Succeeded : " + acceptedState.summarize() + " (job " + str(identifier) + ") at " + str(datetime.datetime.now()))
-          maxRunningSize = max([state.size() for state in activeTestStatesById.values()])
+          if debug:
+            print("Succeeded : " + acceptedState.summarize() + " (job " + str(identifier) + ") at " + str(datetime.datetime.now()))
+          maxRunningSize = max(state.size() for state in activeTestStatesById.values())
           maxRelevantSize = maxRunningSize / len(activeTestStatesById)
           if acceptedState.size() < maxRelevantSize:
             print("Queuing a retest of response of size " + str(acceptedState.size()) + " from job " + str(identifier) + " because a much larger job of size " + str(maxRunningSize) + " is still running")
@@ -769,25 +1109,28 @@ class DiffRunner(object):
                   print("Successful state from work path " + str(identifier) + " wasn't correctly copied to bestState. Could the test command be deleting files that previously existed?")
                   sys.exit(1)
               # record that the results from any previously started process are no longer guaranteed to be valid
-              for i in activeTestStatesById.keys():
-                if i != identifier:
-                  invalidatedIds.add(i)
+              invalidatedIds.update(i for i in activeTestStatesById if i != identifier)
               # record our first success
               if numJobsAtFirstSuccessAfterMerge is None:
                 numJobsAtFirstSuccessAfterMerge = len(availableTestStates)
         else:
+          failedTestKeys.add(testKeysById[identifier])
           if not os.path.isdir(self.sampleFailure_path):
             # save sample failure path where user can see it
             print("Saving sample failed state to " + str(self.sampleFailure_path))
             fileIo.ensureDirExists(self.sampleFailure_path)
             self.full_resetTo_state.expandedWithEmptyEntriesFor(box).withConflictsFrom(box, True).apply(self.sampleFailure_path)
-          #print("Failed : " + box.summarize() + " (job " + str(identifier) + ") at " + str(datetime.datetime.now()))
+          if debug:
+            print("Failed : " + box.summarize() + " (job " + str(identifier) + ") at " + str(datetime.datetime.now()))
           # count failures
           numConsecutiveFailures += 1
           numFailuresSinceLastSplitOrSuccess += 1
           # find any children that failed and queue a re-test of those children
           updatedChild = box.withoutDuplicatesFrom(box.withConflictsFrom(self.resetTo_state))
-          if updatedChild.size() > 0:
+          if identifier in splitActiveIds:
+            # we already queued the pieces of this state while it was still running
+            pass
+          elif updatedChild.size() > 0:
             if numConsecutiveFailures >= 4:
               # Suppose we are trying to identify n single-file changes that cause failures
               # Suppose we have tried c changes of size s, each one of which failed
@@ -805,11 +1148,14 @@ class DiffRunner(object):
             split = updatedChild.splitOnce(splitFactor)
             if len(split) > 1:
               numFailuresSinceLastSplitOrSuccess = 0
-            availableTestStates += split
+            availableTestStates.addAll(split)
         # clear invalidation status
         if identifier in invalidatedIds:
           invalidatedIds.remove(identifier)
+        splitActiveIds.discard(identifier)
         del activeTestStatesById[identifier]
+        del testKeysById[identifier]
+        heapq.heappush(freeJobIds, identifier)
         # Check whether we've had enough failures lately to warrant checking for the possibility of dependencies among files
         if numJobsAtFirstSuccessAfterMerge is not None:
           if len(availableTestStates) > 3 * numJobsAtFirstSuccessAfterMerge:
@@ -823,10 +1169,10 @@ class DiffRunner(object):
             print("#                                                           #")
             print("#############################################################")
             rejoinedState = FilesState()
-            for state in availableTestStates:
-              rejoinedState = rejoinedState.expandedWithEmptyEntriesFor(state).withConflictsFrom(state)
+            for state in availableTestStates.getStates():
+              rejoinedState.mergeFrom(state)
             rejoinedState = rejoinedState.withoutDuplicatesFrom(self.resetTo_state)
-            availableTestStates = rejoinedState.splitOnce(initialSplitSize)
+            availableTestStates = TestStateQueue(rejoinedState.splitOnce(initialSplitSize))
             numFailuresSinceLastSplitOrSuccess = 0
             numJobsAtFirstSuccessAfterMerge = None
             numCompletionsSinceLastPoolSizeChange = 0
@@ -835,20 +1181,19 @@ class DiffRunner(object):
       if len(probablyAcceptableStates) > 0 and (len(probablyAcceptableStates) >= len(activeTestStatesById) + 1 or numConsecutiveFailures >= len(activeTestStatesById) or len(activeTestStatesById) < 1):
         probablyAcceptableState = FilesState()
         for state in probablyAcceptableStates:
-          probablyAcceptableState = probablyAcceptableState.expandedWithEmptyEntriesFor(state).withConflictsFrom(state)
+          probablyAcceptableState.mergeFrom(state)
         probablyAcceptableState = probablyAcceptableState.withoutDuplicatesFrom(self.resetTo_state)
         if probablyAcceptableState.size() > 0:
           print("Retesting " + str(len(probablyAcceptableStates)) + " previous likely successful states as a single test: " + probablyAcceptableState.summarize())
-          availableTestStates = [probablyAcceptableState] + availableTestStates
+          availableTestStates.addFirst(probablyAcceptableState)
         probablyAcceptableStates = []
       if len(availableTestStates) < 1 and len(activeTestStatesById) < 1:
         print("Error: no changes remain left to test. It was expected that applying all changes would fail")
         break
 
-      # if we haven't checked everything yet, then try to queue more jobs
-      if numFailuresSinceLastSplitOrSuccess < self.resetTo_state.size():
-        availableTestStates.sort(reverse=True, key=FilesState.size)
-
+      nextSplitTime = None
+      # if we haven't checked everything yet, then try to queue more jobs, once we've processed any responses that are already waiting
+      if numFailuresSinceLastSplitOrSuccess < self.resetTo_state.size() and len(receivedResponses) < 1:
         if self.maxNumJobsAtOnce != "auto":
           targetNumJobs = self.maxNumJobsAtOnce
         else:
@@ -875,23 +1220,72 @@ class DiffRunner(object):
         if timedOut:
           print("Timeout reached, not starting new jobs")
         else:
-          while len(activeTestStatesById) < targetNumJobs and len(activeTestStatesById) < self.resetTo_state.size() and len(availableTestStates) > 0:
+          while len(activeTestStatesById) < targetNumJobs and len(activeTestStatesById) < self.resetTo_state.size():
+            if len(availableTestStates) < 1:
+              # We have an idle job slot but nothing queued, so split the largest running state and test its pieces too
+              # If that running state fails, then its pieces will already be running, and if it passes, they will be skipped
+              # Most jobs finish in about the average test duration, so we only split a job that has run longer than that
+              # (Otherwise we would mostly be running duplicate tests whose results we won't need)
+              if not self.splitRunningJobs or numTimedTests < 1:
+                break
+              splitAfterSeconds = totalTestSeconds / numTimedTests
+              splittableIds = [i for i in jobStartTimesById if i not in splitActiveIds and activeTestStatesById[i].size() > 1]
+              currentTime = time.monotonic()
+              longRunningIds = [i for i in splittableIds if currentTime - jobStartTimesById[i] >= splitAfterSeconds]
+              if len(longRunningIds) < 1:
+                if len(splittableIds) > 0:
+                  # check again once the first of these jobs has run long enough
+                  nextSplitTime = min(jobStartTimesById[i] for i in splittableIds) + splitAfterSeconds
+                break
+              splittableIds = longRunningIds
+              largestId = max(splittableIds, key=lambda i: activeTestStatesById[i].size())
+              splitActiveIds.add(largestId)
+              split = activeTestStatesById[largestId].splitOnce(2)
+              if len(split) > 1:
+                print("Splitting running job " + str(largestId) + " into " + str(len(split)) + " more jobs to use an idle job slot")
+                numFailuresSinceLastSplitOrSuccess = 0
+                availableTestStates.addAll(split)
+              continue
             # find next pending job
-            box = availableTestStates[0]
+            box = availableTestStates.pop()
+            # skip any changes that were accepted after this state was queued
+            box = box.withoutDuplicatesFrom(box.withConflictsFrom(self.resetTo_state))
+            if box.size() < 1:
+              continue
             # find next unused job id
-            jobId = 0
-            while jobId in activeTestStatesById:
-              jobId += 1
-            # start job
-            workingDir = self.getWorkPath(jobId)
-            cacheDir = self.getFilesCachePath(jobId)
-            if jobId in workerStatesById:
-              workerPreviousState = workerStatesById[jobId]
+            if len(freeJobIds) > 0:
+              jobId = heapq.heappop(freeJobIds)
             else:
-              workerPreviousState = FilesState()
-            runJobInOtherProcess(self.testScript_path, workingDir, cacheDir, workerPreviousState, self.assumeNoSideEffects, self.full_resetTo_state, box, queue, jobId)
+              jobId = numJobIds
+              numJobIds += 1
+            testKey = self.getTestKey(box)
+            if testKey in failedTestKeys:
+              # we already ran this exact test and it failed, so we don't need to run it again
+              print("Skipping test of " + box.summarize() + " because it already failed")
+              receivedResponses.append((jobId, False))
+            else:
+              # start job
+              if jobId in workersById and not workersById[jobId].process.is_alive():
+                # this worker died after reporting its previous result
+                print("Worker " + str(jobId) + " stopped unexpectedly; starting a new one")
+                del workersById[jobId]
+              if jobId not in workersById:
+                workingDir = self.getWorkPath(jobId)
+                workersById[jobId] = Worker(jobId, self.testScript_path, workingDir, self.assumeNoSideEffects, self.full_resetTo_state, len(self.resetTo_updates), queue)
+              workersById[jobId].startJob(box, self.resetTo_updates)
+              jobStartTimesById[jobId] = time.monotonic()
             activeTestStatesById[jobId] = box
-            availableTestStates = availableTestStates[1:]
+            testKeysById[jobId] = testKey
+
+      # collect the responses from any jobs that finished while we were busy, so that we can process them without waiting
+      while len(activeTestStatesById) > len(receivedResponses):
+        try:
+          receivedResponses.append(queue.get_nowait())
+        except Empty:
+          break
+
+    for worker in workersById.values():
+      worker.stop()
 
     if timedOut:
       wasSuccessful = False
@@ -927,6 +1321,7 @@ def main(args):
   workPath = "/tmp/diff-filterer"
   timeoutSeconds = None
   maxNumJobsAtOnce = 1
+  splitRunningJobs = False
   while len(args) > 0:
     arg = args[0]
     if arg == "--assume-no-side-effects":
@@ -953,6 +1348,10 @@ def main(args):
         maxNumJobsAtOnce = int(val)
       args = args[2:]
       continue
+    if arg == "--split-running-jobs":
+      splitRunningJobs = True
+      args = args[1:]
+      continue
     if arg == "--timeout":
       if len(args) < 2:
         usage()
@@ -981,7 +1380,7 @@ def main(args):
   if not os.path.exists(failingPath):
     print("Specified failing path " + failingPath + " does not exist")
     sys.exit(1)
-  success = DiffRunner(failingPath, passingPath, shellCommand, workPath, assumeNoSideEffects, assumeInputStatesAreCorrect, maxNumJobsAtOnce, timeoutSeconds).run()
+  success = DiffRunner(failingPath, passingPath, shellCommand, workPath, assumeNoSideEffects, assumeInputStatesAreCorrect, maxNumJobsAtOnce, splitRunningJobs, timeoutSeconds).run()
   endTime = datetime.datetime.now()
   duration = endTime - startTime
   if success:
@@ -990,4 +1389,5 @@ def main(args):
     print("Failed in " + str(duration))
     sys.exit(1)
 
-main(sys.argv[1:])
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -60,20 +60,18 @@ def main():
     if ("kotlin-native-linux" in artifact_name): artifact_name = fix_kotlin_native(artifact_name)
 
     # Add -Dorg.gradle.debug=true to debug or --stacktrace to see the stack trace
-    command = './gradlew --build-file build.gradle.kts -PartifactName=%s' % (
-        artifact_name)
+    # The arguments are passed as a list so that no shell is needed to run gradlew
+    command = ['./gradlew', '--build-file', 'build.gradle.kts',
+               '-PartifactName=%s' % (artifact_name)]
     metalava_build_id = parse_result.metalava_build_id
     if (metalava_build_id):
-      command = command + ' -PmetalavaBuildId=%s' % (metalava_build_id)
+      command.append('-PmetalavaBuildId=%s' % (metalava_build_id))
     if (parse_result.allow_bintray):
-      command = command + ' -PallowBintray'
+      command.append('-PallowBintray')
     if (parse_result.allow_jetbrains_dev):
-      command = command + ' -PallowJetbrainsDev'
+      command.append('-PallowJetbrainsDev')
 
-    process = subprocess.Popen(command,
-                               shell=True,
-                               stdin=subprocess.PIPE)
-    process.communicate()
+    process = subprocess.run(command, stdin=subprocess.DEVNULL)
     assert not process.returncode
 
     # Generate our own .pom file so Gradle will use this artifact without also checking the internet.
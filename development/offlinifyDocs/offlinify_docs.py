@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 
 import argparse
+import concurrent.futures
+import functools
 from pathlib import Path
 import os
 import re
@@ -8,6 +10,12 @@ import shutil
 import sys
 import urllib
 
+try:
+  from bs4 import BeautifulSoup
+except ModuleNotFoundError:
+  # check_env reports this
+  BeautifulSoup = None
+
 SCRIPT_PATH = Path(__file__).parent.absolute()
 DEFAULT_DIR  = os.path.abspath(os.path.join(SCRIPT_PATH, '../../../../out/androidx/docs-tip-of-tree/build/javadoc'))
 
@@ -16,13 +24,15 @@ CSS_SOURCE_PATH = os.path.abspath(os.path.join(SCRIPT_PATH, STYLE_FNAME))
 
 VERBOSE = False
 
+# absolute paths of the files under the javadoc root, or None if it hasn't been listed
+KNOWN_FILES = None
+KNOWN_FILES_ROOT = None
+
 def check_env():
   """
   Error early if any system setup is missing
   """
-  try:
-    from bs4 import BeautifulSoup
-  except ModuleNotFoundError:
+  if BeautifulSoup is None:
     print("ERROR: This script requires beatifulsoup module `bs4` to run. Please install with pip or another package manager.")
     sys.exit(-1)
 
@@ -95,6 +105,40 @@ def fix_css(soup, relative_css):
   new_tag = soup.new_tag("link", rel="stylesheet", href=relative_css)
   soup.head.append(new_tag)
 
+@functools.lru_cache(maxsize=None)
+def is_file(path):
+  """
+  Same as os.path.isfile, but cached because many pages link to the same files, and none are added or removed while we run
+  Paths under the javadoc root are looked up in KNOWN_FILES rather than checked on disk
+  """
+  if KNOWN_FILES is not None and path.startswith(KNOWN_FILES_ROOT + os.sep) and not path.endswith(os.sep):
+    return os.path.normpath(path) in KNOWN_FILES
+  return os.path.isfile(path)
+
+def list_files(javadocroot):
+  """
+  Returns the set of absolute paths of all files under javadocroot, and a list of the html files among them
+  """
+  all_files = set()
+  html_files = []
+  pending_dirs = [javadocroot]
+  while pending_dirs:
+    try:
+      entries = os.scandir(pending_dirs.pop())
+    except OSError:
+      # like os.walk, skip directories we can't list
+      continue
+    with entries:
+      for entry in entries:
+        # DirEntry caches the file type from the directory listing, so this usually doesn't need a stat()
+        if entry.is_dir(follow_symlinks=False):
+          pending_dirs.append(entry.path)
+        elif not entry.is_dir():
+          all_files.add(entry.path)
+          if entry.name.endswith('.html'):
+            html_files.append(Path(entry.path))
+  return all_files, html_files
+
 def fix_links(soup, rootdir, file_loc, last_root):
   """
   Fix any in-javadoc links to be relative instead of absolute so they can be opened from the filesystem.
@@ -108,7 +152,7 @@ def fix_links(soup, rootdir, file_loc, last_root):
     non_root_generated = parsed_url.path
 
     # see if we can just fix it quick
-    if last_root is not None and os.path.isfile(os.path.join(last_root, non_root_generated)):
+    if last_root is not None and is_file(os.path.join(last_root, non_root_generated)):
       new_path = generate_relative_link(os.path.join(last_root, non_root_generated), file_loc)
       atag['href'] = urllib.parse.urlunparse(parsed_url._replace(path=new_path))
       continue
@@ -120,7 +164,7 @@ def fix_links(soup, rootdir, file_loc, last_root):
       last_current_path = None
       while current_path != last_current_path: # if there's a better way to detect root swap it
         test_path = os.path.join(current_path.as_posix(), non_root_generated)
-        if os.path.isfile(test_path):
+        if is_file(test_path):
           last_root = current_path.as_posix()
           new_path = generate_relative_link(test_path, file_loc)
           new_path_abs = Path(file_loc).parent.joinpath(new_path).as_posix()
@@ -141,30 +185,80 @@ def generate_relative_link(destination, source):
   """
   absdest = os.path.abspath(destination)
   abssource = os.path.abspath(source)
-  if os.path.isfile(abssource):
-    abssource = Path(abssource).parent.absolute()
-  return os.path.relpath(absdest, start=abssource)
+  if is_file(abssource):
+    abssource = os.path.dirname(abssource)
+  return relative_path(absdest, abssource)
 
-def fix_html(javadocroot):
+@functools.lru_cache(maxsize=None)
+def relative_path(path, start):
   """
-  Inject css link and fix all <a href to work on the local file system for all files under javadocroot
+  Same as os.path.relpath, but cached because pages in the same directory often link to the same files
   """
-  from bs4 import BeautifulSoup
+  return os.path.relpath(path, start=start)
 
-  css_path = copy_css_to_root(javadocroot)
+def get_html_parser():
+  """
+  Use lxml's parser (written in C) if it's installed, otherwise fall back to the slower built in html.parser
+  """
+  try:
+    import lxml
+    return "lxml"
+  except ModuleNotFoundError:
+    return "html.parser"
+
+def init_worker(verbose, known_files, known_files_root):
+  """
+  Match the parent process's settings in worker processes
+  """
+  global VERBOSE, KNOWN_FILES, KNOWN_FILES_ROOT
+  VERBOSE = verbose
+  KNOWN_FILES = known_files
+  KNOWN_FILES_ROOT = known_files_root
+
+def fix_html_files(html_files, javadocroot, css_path, html_parser):
+  """
+  Inject css link and fix all <a href to work on the local file system for each of html_files
+  """
+  # nearby files usually link to the same places, so each file starts searching from where the previous file's links were found
   last_relative_root = None
-  for html_file in list(Path(javadocroot).glob('**/*.html')):
-    relative_css_path = os.path.relpath(css_path, Path(html_file).parent)
-    with html_file.open() as fd:
-      parsed_html = BeautifulSoup(fd, "html.parser")
+  # the relative path to the css file only depends on the directory of each html file
+  relative_css_paths = {}
+  for html_file in html_files:
+    html_dir = html_file.parent
+    relative_css_path = relative_css_paths.get(html_dir)
+    if relative_css_path is None:
+      relative_css_path = os.path.relpath(css_path, html_dir)
+      relative_css_paths[html_dir] = relative_css_path
+    # BeautifulSoup decodes the bytes itself (using any charset the page declares), so we don't decode them separately first
+    original_html = html_file.read_bytes()
+    parsed_html = BeautifulSoup(original_html, html_parser)
 
     fix_css(parsed_html, relative_css_path)
     last_relative_root = fix_links(parsed_html, javadocroot, html_file, last_relative_root)
 
-    # replace the file
-    html_file.write_text(str(parsed_html))
+    # replace the file, unless it was already fixed (for example by a previous run)
+    fixed_html = parsed_html.encode('utf-8')
+    if fixed_html != original_html:
+      html_file.write_bytes(fixed_html)
     log(f"{os.path.relpath(html_file)} ✅", flush=False)
 
+def fix_html(javadocroot):
+  """
+  Inject css link and fix all <a href to work on the local file system for all files under javadocroot
+  """
+  css_path = copy_css_to_root(javadocroot)
+  html_parser = get_html_parser()
+  # We list every file once up front so that checking where links point doesn't need a stat() per link
+  known_files, html_files = list_files(javadocroot)
+  # Each file can be fixed independently, so we split them into batches and fix the batches in parallel
+  batch_size = 64
+  batches = [html_files[i:i + batch_size] for i in range(0, len(html_files), batch_size)]
+  with concurrent.futures.ProcessPoolExecutor(initializer=init_worker, initargs=(VERBOSE, known_files, javadocroot)) as executor:
+    futures = [executor.submit(fix_html_files, batch, javadocroot, css_path, html_parser) for batch in batches]
+    for future in futures:
+      # rethrow any error from the batch
+      future.result()
+
 def main(args=None):
   check_env()
   args = parse_args()
@@ -17,12 +17,12 @@
 import sys
 import os
 import argparse
+import re
 from datetime import date
 import subprocess
 from shutil import rmtree
 from shutil import copyfile
-from distutils.dir_util import copy_tree
-from distutils.dir_util import DistutilsFileError
+from shutil import copytree
 
 # cd into directory of script
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -40,6 +40,14 @@ LIBRARY_GROUPS_FP = os.path.join(FRAMEWORKS_SUPPORT_FP, LIBRARY_GROUPS_REL)
 DOCS_TOT_BUILD_GRADLE_REL = './docs-tip-of-tree/build.gradle'
 DOCS_TOT_BUILD_GRADLE_FP = os.path.join(FRAMEWORKS_SUPPORT_FP, DOCS_TOT_BUILD_GRADLE_REL)
 
+# The lines of LIBRARY_GROUPS_FP, or None if it hasn't been read yet.
+# This script is the only thing modifying that file while it runs, so we
+# read it once and keep this list up to date when we change the file.
+library_groups_lines_cache = None
+# A dict from each group ID in LIBRARY_GROUPS_FP to whether it is atomic,
+# or None if it needs to be recomputed from library_groups_lines_cache.
+library_group_atomicity_cache = None
+
 # Set up input arguments
 parser = argparse.ArgumentParser(
     description=("""Genereates new project in androidx."""))
@@ -66,8 +74,8 @@ def cp(src_path_dir, dst_path_dir):
         print_e('cp error: Source path %s does not exist.' % src_path_dir)
         return None
     try:
-        copy_tree(src_path_dir, dst_path_dir)
-    except DistutilsFileError as err:
+        copytree(src_path_dir, dst_path_dir, dirs_exist_ok=True)
+    except OSError as err:
         print_e('FAIL: Unable to copy %s to destination %s' % (src_path_dir, dst_path_dir))
         return None
     return dst_path_dir
@@ -165,6 +173,27 @@ def sed(before, after, file):
     with open(file,"w") as f:
         f.write(new_file_contents)
 
+def sed_all(replacements, file):
+    """Like calling sed for each of replacements, but reads and writes file only once.
+
+    All of the replacements are made in a single pass over the file, so
+    text inserted by one replacement is never replaced by another. Where
+    one string to replace starts with another, the longer one is replaced.
+
+    Args:
+        replacements: a dict from each string to replace to its replacement
+        file: the file to update
+    """
+    with open(file) as f:
+       file_contents = f.read()
+    # regex alternation takes the first alternative that matches, so we list the longest strings first
+    befores = sorted(replacements, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(before) for before in befores))
+    file_contents = pattern.sub(lambda match: replacements[match.group(0)], file_contents)
+    # write back the file
+    with open(file,"w") as f:
+        f.write(file_contents)
+
 def remove_line(line_to_remove, file):
     with open(file) as f:
        file_contents = f.readlines()
@@ -388,37 +417,27 @@ def create_directories(group_id, artifact_id, is_kotlin_project):
                         package_docs_filename)
         mv_dir(full_artifact_path + "/src/main/groupId", full_package_docs_dir)
 
-    # Populate the library type
+    # Populate the library type, YEAR, PACKAGE and VERSION macro, and
+    # update the name and description in the build.gradle
     library_type = get_library_type(artifact_id)
-    sed("<LIBRARY_TYPE>", library_type, full_artifact_path + "/build.gradle")
-
-    # Populate the YEAR
     year = get_year()
-    sed("<YEAR>", year, full_artifact_path + "/build.gradle")
-    sed("<YEAR>", year, full_package_docs_file)
-    if is_compose_project:
-        sed("<YEAR>", year, full_artifact_path + "/src/androidAndroidTest/AndroidManifest.xml")
-        sed("<YEAR>", year, full_artifact_path + "/src/androidMain/AndroidManifest.xml")
-    else:
-        sed("<YEAR>", year, full_artifact_path + "/src/androidTest/AndroidManifest.xml")
-        sed("<YEAR>", year, full_artifact_path + "/src/main/AndroidManifest.xml")
-
-    # Populate the PACKAGE
     package = generate_package_name(group_id, artifact_id)
-    sed("<PACKAGE>", package, full_package_docs_file)
+    group_id_version_macro = get_group_id_version_macro(group_id)
+    sed_all({
+        "<LIBRARY_TYPE>": library_type,
+        "<YEAR>": year,
+        "<GROUPID>": group_id_version_macro,
+        "<NAME>": group_id + ":" + artifact_id,
+        "<DESCRIPTION>": project_description,
+    }, full_artifact_path + "/build.gradle")
+    year_and_package = {"<YEAR>": year, "<PACKAGE>": package}
+    sed_all(year_and_package, full_package_docs_file)
     if is_compose_project:
-        sed("<PACKAGE>", package, full_artifact_path + "/src/androidAndroidTest/AndroidManifest.xml")
-        sed("<PACKAGE>", package, full_artifact_path + "/src/androidMain/AndroidManifest.xml")
+        sed_all(year_and_package, full_artifact_path + "/src/androidAndroidTest/AndroidManifest.xml")
+        sed_all(year_and_package, full_artifact_path + "/src/androidMain/AndroidManifest.xml")
     else:
-        sed("<PACKAGE>", package, full_artifact_path + "/src/androidTest/AndroidManifest.xml")
-        sed("<PACKAGE>", package, full_artifact_path + "/src/main/AndroidManifest.xml")
-
-    # Populate the VERSION macro
-    group_id_version_macro = get_group_id_version_macro(group_id)
-    sed("<GROUPID>", group_id_version_macro, full_artifact_path + "/build.gradle")
-    # Update the name and description in the build.gradle
-    sed("<NAME>", group_id + ":" + artifact_id, full_artifact_path + "/build.gradle")
-    sed("<DESCRIPTION>", project_description, full_artifact_path + "/build.gradle")
+        sed_all(year_and_package, full_artifact_path + "/src/androidTest/AndroidManifest.xml")
+        sed_all(year_and_package, full_artifact_path + "/src/main/AndroidManifest.xml")
 
 
 def get_new_settings_gradle_line(group_id, artifact_id):
@@ -582,6 +601,19 @@ def insert_new_group_id_into_library_versions_kt(group_id, artifact_id):
     insert_new_group_id_into_library_groups_kt(group_id, artifact_id)
 
 
+def read_library_groups_kt():
+    """Returns the lines of the LibraryGroups.kt file.
+
+    The file is only read the first time this is called. Callers that
+    modify the returned list must also write it back to the file.
+    """
+    global library_groups_lines_cache
+    if library_groups_lines_cache is None:
+        with open(LIBRARY_GROUPS_FP, 'r') as f:
+            library_groups_lines_cache = f.readlines()
+    return library_groups_lines_cache
+
+
 def insert_new_group_id_into_library_groups_kt(group_id, artifact_id):
     """Inserts a group ID into the LibraryGroups.kt file.
 
@@ -595,9 +627,7 @@ def insert_new_group_id_into_library_groups_kt(group_id, artifact_id):
     new_group_id_insert_line = 0
     new_group_id_variable_name = group_id.replace("androidx.","").replace(".","_").upper()
 
-    # Open file for reading and get all lines
-    with open(LIBRARY_GROUPS_FP, 'r') as f:
-        library_groups_lines = f.readlines()
+    library_groups_lines = read_library_groups_kt()
     num_lines = len(library_groups_lines)
 
     for i in range(num_lines):
@@ -627,6 +657,8 @@ def insert_new_group_id_into_library_groups_kt(group_id, artifact_id):
     # Open file for writing and update all lines
     with open(LIBRARY_GROUPS_FP, 'w') as f:
         f.writelines(library_groups_lines)
+    global library_group_atomicity_cache
+    library_group_atomicity_cache = None
 
 def is_group_id_atomic(group_id):
     """Checks if a group ID is atomic using the LibraryGroups.kt file.
@@ -643,13 +675,20 @@ def is_group_id_atomic(group_id):
     Args:
         group_id: group_id of the library we're checking.
     """
-    # Open file for reading and get all lines
-    with open(LIBRARY_GROUPS_FP, 'r') as f:
-        library_groups_lines = f.readlines()
-    num_lines = len(library_groups_lines)
+    # If the group id does not exist yet, just default to false.
+    return get_library_group_atomicity().get(group_id, False)
 
-    for i in range(num_lines):
-        cur_line = library_groups_lines[i]
+def get_library_group_atomicity():
+    """Returns a dict from each group ID in LibraryGroups.kt to whether it is atomic.
+
+    The dict is only built the first time this is called after
+    LibraryGroups.kt changes, so that checking a group ID is a dict lookup.
+    """
+    global library_group_atomicity_cache
+    if library_group_atomicity_cache is not None:
+        return library_group_atomicity_cache
+    atomicity = {}
+    for cur_line in read_library_groups_kt():
         # Skip any line that doesn't declare a version.
         if 'LibraryGroup(' not in cur_line: continue
         # Skip the definition of the LibraryGroup class too.
@@ -657,14 +696,12 @@ def is_group_id_atomic(group_id):
         group_id_in_line = cur_line.split('LibraryGroup(')[1].split('"')[1]
         # Account for Compose group id substitution variable.
         group_id_in_line = group_id_in_line.replace("$group", "androidx.compose")
-        if group_id_in_line == group_id:
-            # Found the right line.
-            if 'LibraryVersions.' in cur_line and 'null' not in cur_line:
-                return True
-            else:
-                return False
-    # The group id does not exist yet, so just default to false.
-    return False
+        # If a group id is declared more than once, the first declaration wins.
+        if group_id_in_line not in atomicity:
+            atomicity[group_id_in_line] = ('LibraryVersions.' in cur_line and
+                                           'null' not in cur_line)
+    library_group_atomicity_cache = atomicity
+    return atomicity
 
 def print_todo_list(group_id, artifact_id, is_kotlin_project):
     """Prints to the todo list once the script has finished.
@@ -247,6 +247,36 @@ class TestReplacements(unittest.TestCase):
         self.assertEqual("d\nb\nc", file_contents)
         rm(out_dir)
 
+    def test_sed_all(self):
+        out_dir = "./out"
+        test_file = out_dir + "/temp.txt"
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with open(test_file,"w") as f:
+           f.write("foo\nfoobar\n<A>\n<B>")
+        sed_all({"foo": "x", "foobar": "y", "<A>": "<B>", "<B>": "b"}, test_file)
+
+        # the longest matching key is used, and replaced text isn't replaced again
+        with open(test_file) as f:
+           file_contents = f.read()
+        self.assertEqual("x\ny\n<B>\nb", file_contents)
+
+        # matches the result of calling sed for each key, longest first
+        with open(test_file,"w") as f:
+           f.write("foo\nfoobar\n<B>")
+        sed("foobar", "y", test_file)
+        sed("foo", "x", test_file)
+        sed("<B>", "b", test_file)
+        with open(test_file) as f:
+           sequential_contents = f.read()
+        with open(test_file,"w") as f:
+           f.write("foo\nfoobar\n<B>")
+        sed_all({"foo": "x", "foobar": "y", "<B>": "b"}, test_file)
+        with open(test_file) as f:
+           file_contents = f.read()
+        self.assertEqual(sequential_contents, file_contents)
+        rm(out_dir)
+
     def test_mv_dir_within_same_dir(self):
         src_out_dir = "./src_out"
         test_src_file = src_out_dir + "/temp.txt"